@@ -1,4 +1,4 @@
-from random import randint
+from random import randint, choices
 from PIL import Image, ImageFont, ImageDraw, ImageChops, ImageMorph, ImageEnhance
 from os import path
 from modules.utils import random_from_list
@@ -36,10 +36,8 @@ class CreateImgGtPair:
         str_length = randint(
             self.params["gt_length_interval"][0], self.params["gt_length_interval"][1]
         )
-        gt = ""  # Ground truth store here
-        for _ in range(str_length):
-            gt += random_from_list(self.wordlist) + " "
-        gt = gt[:-1]  # Remove additional new-line character at the end of gt
+        # Ground truth store here
+        gt = " ".join(choices(self.wordlist, k=str_length))
         font_path = random_from_list(self.params["fontlist"])
         font = ImageFont.truetype(font_path, font_size)
         # Calculate size of the text (Width and height)
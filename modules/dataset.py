@@ -1,10 +1,13 @@
 from genericpath import isdir
 import torch
+from torch import nn
 from torch.utils.data import Dataset
+from torch.nn.utils.rnn import pad_sequence
 from torchvision.transforms.functional import resize
 import numpy as np
+import random
 from .create_pairs import CreateImgGtPair
-from typing import Union
+from typing import List
 from glob import glob
 from os import path
 import csv
@@ -28,6 +31,11 @@ class OCRDataset(Dataset):
         image_name_format = params["dataset"]["image_name_format"]
         dataset_dir = params["dataset"]["dataset_dir"]
         self.transforms = params["training"]["transforms"]
+        self.img_transforms = params["training"]["img_transforms"]
+        # Scripted version of img_transforms. It's created in the process that uses
+        # the dataset (e.g., a DataLoader worker), because scripted modules can't
+        # be pickled to send to the worker processes.
+        self.scripted_img_transforms = None
         self.used_in = used_in
         # List of all directories in the dataset directory.
         dirs = path.join(dataset_dir, "*")
@@ -83,29 +91,107 @@ class OCRDataset(Dataset):
         data["img"] = np.asarray(Image.open(data["img"], "r"))
         if self.transforms:
             data = self.transforms(data)
+        if self.img_transforms is not None:
+            if self.scripted_img_transforms is None:
+                self.scripted_img_transforms = torch.jit.script(self.img_transforms)
+            data["img"] = self.scripted_img_transforms(data["img"])
 
         return data
 
-class Normalize:
+    def __getstate__(self):
+        """
+        Don't pickle the scripted transforms; each process scripts its own copy.
+        """
+        state = self.__dict__.copy()
+        state["scripted_img_transforms"] = None
+        return state
+
+class OCRGPUDataset(Dataset):
+    """
+    Create image/gt pairs artificially once and keep all of them in the memory of
+    the training device. Because pairs are already on the device, there's no need
+    to create pairs or transfer them to the device during the training.
+    """
+
+    def __init__(self, params):
+        """
+        Parameters
+        ----------
+        params (dict): The dict contains all of the parameters. The number of
+        created pairs is ``params["artificial_dataset"]["image_numbers"]``.
+        """
+        device = params["training"]["device"]
+        transforms = params["training"]["transforms"]
+        img_transforms = params["training"]["img_transforms"]
+        pair_creator = CreateImgGtPair(params["artificial_dataset"])
+        # Repeats channels of single-channel images when they're returned
+        self.adjust_channels = AdjustImageChannels(swap_img_axis=False)
+        self.pairs = []
+        for _ in range(params["artificial_dataset"]["image_numbers"]):
+            img, gt, _ = pair_creator.create_pair()
+            data = {"img": img, "gt": gt}
+            if transforms:
+                data = transforms(data)
+            if img_transforms is not None:
+                data["img"] = img_transforms(data["img"])
+            img = data["img"]
+            # Channels repeated by AdjustImageChannels share one storage (stride 0).
+            # Store only one of them; copying the view to the device would allocate
+            # all of the channels.
+            if img.shape[0] > 1 and img.stride(0) == 0:
+                img = img[:1]
+            self.pairs.append({"img": img.to(device), "gt": data["gt"].to(device)})
+        self.pair_count = len(self.pairs)
+
+    def __len__(self):
+        """
+        Return number of data points
+        """
+        return self.pair_count
+
+    def __getitem__(self, data_id):
+        """
+        Return the img/gt (image/ground truth) pair with the given id
+        as a dictionary with two key: img and gt(ground truth).
+        Both of them are tensors on the training device.
+        """
+        pair = self.pairs[data_id]
+        return {"img": self.adjust_channels(pair["img"]), "gt": pair["gt"]}
+
+
+class Normalize(nn.Module):
     """
     Rescale value of pixels to have value between 0 and 1 and then rescale again
     to pixels have value between -1 and +1.
-    (This is a transformer)
+    (This is a transformer and works on image tensors)
     """
 
-    def __init__(self, used_in_train=True):
+    def __init__(self):
+        super().__init__()
+        # ((img / 255) - 0.5) / 0.5 folded into a single multiply-add
+        self.scale = 1 / 127.5
+        self.bias = -1.0
+        # Normalized value of every possible uint8 pixel, so uint8 images are
+        # normalized with a single lookup instead of the arithmetic.
+        self.register_buffer(
+            "lut",
+            torch.arange(256, dtype=torch.float32) * self.scale + self.bias,
+            persistent=False,
+        )
+
+    def forward(self, img: torch.Tensor) -> torch.Tensor:
         """
-        used_in_transformer (bool): when training it should be true and when
-        evaluating and testing this parameter should be false.
+        Return the normalized copy of the image as float32. The input image isn't
+        modified.
         """
-        self.used_in_train = used_in_train
-
-    def __call__(self, sample):
-        if self.used_in_train == True:
-            sample["img"] = ((sample["img"] / 255) - 0.5) / 0.5
-        else:
-            sample = ((sample / 255) - 0.5) / 0.5
-        return sample
+        if img.dtype == torch.uint8:
+            # Index with long; a uint8 index would be taken as a mask
+            return self.lut.to(img.device)[img.long()]
+        if img.dtype == torch.float32:
+            return img.mul(self.scale).add_(self.bias)
+        # Cast first so the arithmetic runs in float32; the cast is a new tensor
+        # and can be changed in place.
+        return img.to(torch.float32).mul_(self.scale).add_(self.bias)
 
 
 class ToTensor:
@@ -117,84 +203,80 @@ class ToTensor:
     """
 
     def __call__(self, sample):
+        img = sample["img"]
+        # uint8 images are kept as they are because Normalize maps them to float32
+        # with a lookup table. Other images are converted to float32 to prevent
+        # promotion to float64 in the next transforms.
+        if img.dtype != np.uint8:
+            img = np.ascontiguousarray(img, dtype=np.float32)
+        else:
+            img = np.ascontiguousarray(img)
         return {
-            "img": torch.from_numpy(sample["img"]),
-            "gt": torch.from_numpy(sample["gt"]),
+            "img": torch.from_numpy(img),
+            "gt": torch.from_numpy(np.ascontiguousarray(sample["gt"], dtype=np.int64)),
         }
 
 
-class Resize:
+class Resize(nn.Module):
     """
     A class for resizing images
-    (This is a transformer)
+    (This is a transformer and works on image tensors)
     """
 
-    def __init__(self, size):
+    def __init__(self, size: List[int]):
         """
         Parameters
         ----------
         size (tuple or list): Size of returned image
         """
-        self.size = size
+        super().__init__()
+        self.size = list(size)
 
-    def __call__(self, sample):
-        sample["img"] = resize(sample["img"], self.size)
-        return sample
+    def forward(self, img: torch.Tensor) -> torch.Tensor:
+        return resize(img, self.size)
 
 
-class AdjustImageChannels:
+class AdjustImageChannels(nn.Module):
     """
     Check to all images have three channels. If an input image has one channel,
-    return an image with three channel such that the first channel of output equals
-    to the input and the two oter channels be zero.
-    (This is a transformer)
+    return an image with three channel such that all channels of output equal
+    to the input.
+    (This is a transformer and works on image tensors)
     """
 
-    def __init__(self, used_in_train=True, swap_img_axis=True):
+    def __init__(self, swap_img_axis: bool = True):
         """
         Parameters
         ----------
-        used_in_transformer (bool): When training it should be true and when
-        evaluating and testing this parameter should be false.
         swap_img_axis (bool): Input image to the model should have this shape:
         ``[C x H x W]``. (``C``: Number of channels of the image, ``H``: Height
         of the image, ``W``: Width of the image). If his be true, swap image shape
         from ``(H x W x C)`` to ``(C x H x W)``.
         """
+        super().__init__()
         self.swap_img_axis = swap_img_axis
-        self.used_in_train = used_in_train
 
-    def __call__(self, sample: Union[dict, torch.Tensor]) -> dict:
+    def forward(self, img: torch.Tensor) -> torch.Tensor:
         """
         Parameters
         ----------
-        sample: Should be a dict or an image. (Not a batch of images). Note that
-        first axis of the image should be channels of image. image should has three dimensions.
+        img: Should be an image. (Not a batch of images). Note that first axis of
+        the image should be channels of image. image should has three dimensions.
 
         Returns
         -------
         Returned image is in the form ``(C x H x W)``.
         """
-        if self.used_in_train:
-            # swap color axis because
-            # numpy image: H x W x C
-            # torch image: C x H x W
-            if self.swap_img_axis:
-                sample["img"] = sample["img"].permute(2, 0, 1)
-            shape = sample["img"].shape
-            if shape[0] == 1:
-                temp = torch.zeros(3, shape[1], shape[2])
-                temp[0] = sample["img"]
-                sample["img"] = temp
-        else:
-            if self.swap_img_axis:
-                sample = sample.permute(2, 0, 1)
-            shape = sample.shape
-            if shape[0] == 1:
-                temp = torch.zeros(3, shape[1], shape[2])
-                temp[0] = sample
-                sample = temp
-        return sample
+        # swap color axis because
+        # numpy image: H x W x C
+        # torch image: C x H x W
+        if self.swap_img_axis:
+            img = img.permute(2, 0, 1)
+        if img.shape[0] == 1:
+            # A view that repeats the channel without copying. The batch tensor
+            # it's copied into in dataloader_collate_fn has its own storage.
+            img = img.expand([3, -1, -1])
+        return img
 
 
 def dataloader_collate_fn(batch):
@@ -204,14 +286,31 @@ def dataloader_collate_fn(batch):
     gts in each batch have the same length.
     """
     # Merge ground truth such that they have the same dimension
-    longest_gt = max(data["gt"].shape[0] for data in batch)
-    gts = torch.zeros((len(batch), longest_gt))
-    for i, data in enumerate(batch):
-        gts[i][: len(data["gt"])] = data["gt"]
+    gts = pad_sequence(
+        [data["gt"] for data in batch], batch_first=True, padding_value=0
+    )
 
     longest_height = max(data["img"].shape[1] for data in batch)
     longest_width = max(data["img"].shape[2] for data in batch)
-    imgs = torch.stack(
-        [resize(data["img"], (longest_height, longest_width)) for data in batch], dim=0
+    size = (longest_height, longest_width)
+    # Images with different sizes can't be resized as one batch. Each image is
+    # resized on its own and copied into the preallocated batch tensor.
+    first_img = batch[0]["img"]
+    imgs = torch.empty(
+        (len(batch), first_img.shape[0], longest_height, longest_width),
+        dtype=first_img.dtype,
+        device=first_img.device,
     )
+    for i, data in enumerate(batch):
+        imgs[i].copy_(resize(data["img"], size))
     return {"gt": gts, "img": imgs}
+
+
+def dataloader_worker_init_fn(worker_id):
+    """
+    Seed the ``random`` module of the DataLoader worker. This only restates the
+    default seeding of PyTorch (it already seeds ``random`` and NumPy of each worker
+    differently) to make explicit that ``CreateImgGtPair`` relies on it.
+    Inside a worker ``torch.initial_seed()`` already includes ``worker_id``.
+    """
+    random.seed(torch.initial_seed())
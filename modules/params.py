@@ -3,8 +3,9 @@ from .dataset import ToTensor, Normalize, AdjustImageChannels
 from .utils import CodingString
 from random import randint
 import glob
-from os import path
+from os import path, cpu_count
 from torch import device
+from torch.nn import Sequential
 from torch.cuda import is_available
 
 
@@ -69,10 +70,15 @@ params = {
             [
                 CodingString(unique_chars_map_file),
                 ToTensor(),
-                Normalize(),
-                AdjustImageChannels(),
             ]
         ),
+        # Transforms that apply on the image tensor after the above transforms.
+        # The dataset scripts them in each process to run without the Python
+        # overhead of each transform.
+        "img_transforms": Sequential(
+            Normalize(),
+            AdjustImageChannels(),
+        ),
         # Note that acount space character too. There's no need to add blank character to these chars.
         "vocab_size": 91,
         # The learning rate we start from
@@ -91,9 +97,20 @@ params = {
         # "interval_save_weights": None,  # None: keep best and last only
         "use_ddp": False,  # Use DistributedDataParallel
         "use_apex": True,  # Enable mix-precision with apex package
+        "use_amp": True,  # Enable mix-precision with torch.autocast (on GPU only)
+        # Let cuDNN find the fastest convolution algorithms for each input size.
+        # Enable it only if images have fixed sizes (e.g., with the Resize transform),
+        # because searching runs again for every new size of the image batches.
+        "cudnn_benchmark": False,
+        # Compile the model with torch.compile to fuse its operations (PyTorch 2.0+,
+        # GPU only). Random dropout branches of the model split it into many graphs
+        # and every new image width recompiles, so it's disabled by default.
+        "compile_model": False,
         # Use GPU if available else CPU
         "device": device("cuda:0" if is_available() else "cpu"),
         "batch_size": 16,  # mini-batch size per GPU
+        # Number of worker processes that load image/gt pairs in parallel to training
+        "num_workers": max(1, (cpu_count() or 2) // 2),
         # Number of batches to use in testing the model
         "testing_batch_count": 10,
         # "optimizer": {
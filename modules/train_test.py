@@ -1,4 +1,9 @@
-from .dataset import dataloader_collate_fn, Normalize
+from .dataset import (
+    dataloader_collate_fn,
+    dataloader_worker_init_fn,
+    Normalize,
+    OCRGPUDataset,
+)
 import torch.optim as optim
 from torch.utils.data import DataLoader
 import torch
@@ -11,6 +16,8 @@ from fast_ctc_decode import viterbi_search
 import numpy as np
 from .statistic import word_error_rate, char_error_rate
 from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 
 
@@ -32,14 +39,43 @@ class TrainModel:
         lr (int): If it doesn't set, use the learning rate specified in the parameters dictionary
         """
         self.device = params["training"]["device"]
-        self.model = model(params).to(self.device)
+        # channels_last (NHWC) layout lets cuDNN use its faster convolution kernels
+        self.model = model(params).to(self.device, memory_format=torch.channels_last)
+        # The compiled model shares parameters with self.model and is used only for
+        # training steps. self.model is kept to save and load checkpoints with the
+        # original names of the parameters.
+        self.train_model = self.model
+        # Compiling is only done on GPUs. dynamic=False because the dynamic-shape
+        # compilation of this model fails, so each new image width recompiles.
+        if (
+            params["training"]["compile_model"]
+            and self.device.type == "cuda"
+            and hasattr(torch, "compile")
+        ):
+            self.train_model = torch.compile(self.model, dynamic=False)
         self.dataset = dataset(params)
         self.params = params
+        # Pairs of OCRGPUDataset are already on the device, so they are neither
+        # loaded in worker processes nor pinned.
+        stored_on_device = isinstance(self.dataset, OCRGPUDataset)
+        num_workers = 0 if stored_on_device else params["training"]["num_workers"]
+        # Extra options are only valid when pairs are loaded in worker processes
+        worker_options = {}
+        if num_workers > 0:
+            worker_options = {
+                "prefetch_factor": 2,
+                "persistent_workers": True,
+                "worker_init_fn": dataloader_worker_init_fn,
+            }
         self.dataloader = DataLoader(
             self.dataset,
             batch_size=params["training"]["batch_size"],
             shuffle=True,
             collate_fn=dataloader_collate_fn,
+            # Page-locked batches let the host to device copies run asynchronously
+            pin_memory=(self.device.type == "cuda" and not stored_on_device),
+            num_workers=num_workers,
+            **worker_options,
         )
         self.show_log_step = show_log_steps
         self.loss_fn = CTCLoss(blank=0)
@@ -47,6 +83,17 @@ class TrainModel:
         self.last_epoch_index = 0
         self.lr_val = self.params["training"]["lr_val"]
         self.optimizer = optim.Adam(self.model.parameters(), lr=self.lr_val)
+        # Mixed precision is only used on GPUs. bfloat16 doesn't need loss scaling
+        # but the scaler is kept enabled to have one code path for both types.
+        self.use_amp = params["training"]["use_amp"] and self.device.type == "cuda"
+        self.amp_dtype = torch.float16
+        if self.use_amp and torch.cuda.is_bf16_supported():
+            self.amp_dtype = torch.bfloat16
+        # torch.amp.GradScaler exists since PyTorch 2.3, the CUDA one is deprecated
+        if hasattr(torch.amp, "GradScaler"):
+            self.scaler = torch.amp.GradScaler("cuda", enabled=self.use_amp)
+        else:
+            self.scaler = torch.cuda.amp.GradScaler(enabled=self.use_amp)
         self.max_epoch = self.params["training"]["epoch_numbers"]
         self.checkpoint_dir = self.params["training"]["checkpoint_dir"]
         self.save_check_step = save_check_step
@@ -65,33 +112,50 @@ class TrainModel:
         self.testing_batch_count = params["training"]["testing_batch_count"]
         self.encode = CodingString(self.map_char_file, used_in_train=False)
         self.decode_string = DecodeString(self.map_char_file)
+        # Checkpoints are written to the disk in this thread to not block the training
+        self.checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+        self.checkpoint_future = None
 
-    def fit(self):
+    def fit(self, debug_mode=False):
         """
         Train the model.
+
+        Parameters
+        ----------
+        debug_mode (bool): If true, enable anomaly detection of autograd to find
+        the operation that produced NaN values. It slows down the training a lot.
         """
-        torch.autograd.set_detect_anomaly(True)
+        torch.autograd.set_detect_anomaly(debug_mode)
+        torch.backends.cudnn.benchmark = self.params["training"]["cudnn_benchmark"]
 
         for epoch_index in range(self.last_epoch_index, self.max_epoch):
             running_loss = 0.0
             for i, data in enumerate(self.dataloader):
                 # Send image and gt batch to the device that is specified.
-                imgs = data["img"].to(self.device)
-                gts = data["gt"].to(self.device)
+                imgs = data["img"].to(
+                    self.device, non_blocking=True, memory_format=torch.channels_last
+                )
+                gts = data["gt"].to(self.device, non_blocking=True)
 
                 # zero the parameter gradients
-                self.optimizer.zero_grad()
+                self.optimizer.zero_grad(set_to_none=True)
                 # forward + backward + optimize
-                output = self.model(imgs)
-                # loss = loss_fn(
-                #     output.permute(2, 0, 1),
-                #     gts,
-                #     torch.tensor(imgs.size(0) * [output.size(0)]),
-                #     torch.tensor([gts.size(0) * [gts.size(1)]]),
-                # )
-                loss = self.loss_fn(output, gts)
-                loss.backward()
-                self.optimizer.step()
+                with torch.autocast(
+                    device_type=self.device.type,
+                    dtype=self.amp_dtype,
+                    enabled=self.use_amp,
+                ):
+                    output = self.train_model(imgs)
+                    # loss = loss_fn(
+                    #     output.permute(2, 0, 1),
+                    #     gts,
+                    #     torch.tensor(imgs.size(0) * [output.size(0)]),
+                    #     torch.tensor([gts.size(0) * [gts.size(1)]]),
+                    # )
+                    loss = self.loss_fn(output, gts)
+                self.scaler.scale(loss).backward()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
 
                 running_loss += loss.item()
                 if i % self.show_log_step == 0:
@@ -112,8 +176,9 @@ class TrainModel:
             if epoch_index % self.save_check_step == 0:
                 out = self.save_checkpoint(epoch_index)
                 print(
-                    f"Epoch {epoch_index}) Checkpoint saved. checkpoint path: {out}"
+                    f"Epoch {epoch_index}) Saving checkpoint. checkpoint path: {out}"
                 )
+        self.wait_checkpoint()
 
     def load_checkpoint(self, file_name: str) -> None:
         """
@@ -131,6 +196,10 @@ class TrainModel:
         self.model.load_state_dict(checkpoint["model_state_dict"])
         self.optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
         self.loss_fn.load_state_dict(checkpoint["loss_state_dict"])
+        # Checkpoints saved before mixed precision training don't have the scaler
+        # state, and ones saved with a disabled scaler have an empty state
+        if checkpoint.get("scaler_state_dict"):
+            self.scaler.load_state_dict(checkpoint["scaler_state_dict"])
         self.statistics = checkpoint["statistics"]
 
     def save_checkpoint(self, index: int) -> str:
@@ -142,7 +211,8 @@ class TrainModel:
 
         Returns
         -------
-        Path and name of the file that created
+        Path and name of the file that created. The file is written in the background;
+        call ``wait_checkpoint`` to wait until it's written.
         """
         file_name = self.params["training"]["checkpoint_name"]
         hash_count = file_name.count("#")
@@ -155,18 +225,33 @@ class TrainModel:
             raise FileExistsError(
                 f"A file  with the same name and path exist.\nFile name: {file_path}"
             )
-        torch.save(
+        # Copy states to the CPU, because the training changes them while the
+        # checkpoint is being written.
+        checkpoint = _copy_to_cpu(
             {
                 "model_state_dict": self.model.state_dict(),
                 "optimizer_state_dict": self.optimizer.state_dict(),
                 "loss_state_dict": self.loss_fn.state_dict(),
-                "statistics": self.statistics,
+                "scaler_state_dict": self.scaler.state_dict(),
+                "statistics": deepcopy(self.statistics),
                 "last_epoch_index": self.last_epoch_index,
-            },
-            file_path,
+            }
+        )
+        # Wait for the previous checkpoint to raise its errors, if there are any
+        self.wait_checkpoint()
+        self.checkpoint_future = self.checkpoint_executor.submit(
+            torch.save, checkpoint, file_path
         )
         return file_path
 
+    def wait_checkpoint(self) -> None:
+        """
+        Wait until the last checkpoint is written to the disk.
+        """
+        if self.checkpoint_future is not None:
+            self.checkpoint_future.result()
+            self.checkpoint_future = None
+
     @torch.no_grad()
     def test(self, batch_count=1) -> Tuple[float, float, list]:
         """
@@ -189,9 +274,16 @@ class TrainModel:
         # First index contains OCRed sentence(sentence predicted by the model),
         # second index is target ground truth. They store as decoded strings.
         sample = list()
+        # Create the iterator once; every new iterator throws away the batches
+        # the persistent workers already prefetched.
+        batches = iter(self.dataloader)
         for i in range(batch_count):
-            batch = next(iter(self.dataloader))
-            output = self.model(batch["img"].to(self.device))
+            batch = next(batches)
+            output = self.model(
+                batch["img"].to(
+                    self.device, non_blocking=True, memory_format=torch.channels_last
+                )
+            )
             # Select one sample pair to print to the user
             if i == 0:
                 sample.append(
@@ -230,6 +322,20 @@ class TrainModel:
         return self.statistics
 
 
+def _copy_to_cpu(obj):
+    """
+    Return a copy of ``obj`` such that all of its tensors are copied to the CPU.
+    ``obj`` can be a tensor or nested dicts and lists of tensors.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: _copy_to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_copy_to_cpu(value) for value in obj)
+    return obj
+
+
 class TestModel:
     """
     Test the given model
@@ -329,13 +435,17 @@ class CTCLoss(nn.Module):
         -------
         torch.Tensor: Loss scalar.
         """
-        # preds = preds.log_softmax(-1)
+        # preds = preds.log_softmax(-1)  # The model returns log-probabilities itself
         # batch, seq_len, classes = preds.shape
         batch, classes, seq_len = preds.shape
         # preds = preds.permute(1, 0, 2) # since ctc_loss needs (T, N, C) inputs
-        preds = preds.permute(2, 0, 1)
-        pred_lengths = torch.full(size=(batch,), fill_value=seq_len, dtype=torch.long)
-        target_lengths = torch.count_nonzero(targets, axis=1)
+        # Compute the loss in float32 even when the model runs in mixed precision
+        preds = preds.permute(2, 0, 1).float()
+        # Create lengths on the device of predictions to prevent extra transfers
+        pred_lengths = torch.full(
+            size=(batch,), fill_value=seq_len, dtype=torch.long, device=preds.device
+        )
+        target_lengths = targets.ne(0).sum(dim=1)
 
         return F.ctc_loss(
             preds,
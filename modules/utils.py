@@ -1,4 +1,4 @@
-from random import randint, random
+from random import random, choice
 from bidi.algorithm import get_display
 import arabic_reshaper
 import matplotlib.pyplot as plt
@@ -9,6 +9,7 @@ import csv
 import logging
 import re
 from sys import maxsize
+from functools import lru_cache
 
 
 class CodingString:
@@ -25,16 +26,31 @@ class CodingString:
         used_in_train (bool): Set it true for the training and false for the testing
         and evaluation steps.
         """
-        with open(map_char_file, "r") as f:
-            uniq_file = f.readlines()
         self.used_in_train = used_in_train
         # Create a dict that maps unique chars to ints
-        self.char_to_int_map = {}
-        for line in uniq_file:
-            self.char_to_int_map[line[0]] = int(line[2:5])
+        self.char_to_int_map = load_char_map_file(map_char_file)
         # vocab_size is the number of unique chars plus one that represent blank char.
         # Refer to CTC loss algorithm.
         self.vocab_size = len(self.char_to_int_map)  # + 1
+        # Lookup table indexed by code point of the characters. Characters that
+        # aren't in the map file have the value -1.
+        max_code_point = max(map(ord, self.char_to_int_map), default=0)
+        self.lut = np.full(max_code_point + 1, -1, dtype=int)
+        for char, code in self.char_to_int_map.items():
+            self.lut[ord(char)] = code
+
+    def encode(self, text: str) -> np.ndarray:
+        """
+        Map characters of the text to ints with a single lookup and return them.
+        """
+        code_points = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+        unknown = code_points >= len(self.lut)
+        if not unknown.any():
+            txt_out = self.lut[code_points]
+            unknown = txt_out < 0
+            if not unknown.any():
+                return txt_out
+        raise KeyError(text[int(np.argmax(unknown))])
 
     def __call__(self, input: dict) -> Union[dict, np.ndarray]:
         """
@@ -46,16 +62,11 @@ class CodingString:
         encode its ``gt`` key and return the whole input (with encoded ``gt``).
         else ``input`` is a string and we encode it and return it in a numpy format.
         """
-        txt_out = np.array([], dtype=int)
         if self.used_in_train:
-            for char in input["gt"]:
-                txt_out = np.append(txt_out, self.char_to_int_map[char])
-            input["gt"] = txt_out
+            input["gt"] = self.encode(input["gt"])
             return input
         else:
-            for char in input:
-                txt_out = np.append(txt_out, self.char_to_int_map[char])
-            return txt_out
+            return self.encode(input)
 
 
 class DecodeString:
@@ -67,15 +78,20 @@ class DecodeString:
         """
         map_char_file: The path of the file that map chars to ints
         """
-        with open(map_char_file, "r") as f:
-            uniq_file = f.readlines()
-        # Create a dict that maps unique chars to ints
-        self.int_to_char_map = {}
-        for line in uniq_file:
-            self.int_to_char_map[int(line[2:5])] = line[0]
+        # Create a dict that maps ints to unique chars
+        self.int_to_char_map = {
+            code: char for char, code in _load_char_map(map_char_file).items()
+        }
         # vocab_size is the number of unique chars plus one that represent blank char.
         # Refer to CTC loss algorithm.
         self.vocab_size = len(self.int_to_char_map)  # + 1
+        # Lookup table indexed by the ints. Ints that aren't in the map file have
+        # an empty string as value.
+        self.table = np.full(
+            max(self.int_to_char_map, default=0) + 1, "", dtype=object
+        )
+        for code, char in self.int_to_char_map.items():
+            self.table[code] = char
 
     def __call__(self, encoded_gt: Union[Tensor, np.ndarray]) -> str:
         """
@@ -85,20 +101,24 @@ class DecodeString:
         ----------
         encoded_str (str): the encoded string we want to decode it.
         """
-        txt_out = ""
-        for coded_char in encoded_gt:
-            if (
-                coded_char != 0
-            ):  # coded_char wasn't blank character(defined in CTC class)
-                # coded_char is tensor type, then we convert it to int
-                txt_out += self.int_to_char_map[int(coded_char)]
-        return txt_out
+        if isinstance(encoded_gt, Tensor):
+            encoded_gt = encoded_gt.cpu().numpy()
+        encoded_gt = np.asarray(encoded_gt).astype(np.int64)
+        # Remove blank characters(defined in CTC class)
+        encoded_gt = encoded_gt[encoded_gt != 0]
+        unknown = (encoded_gt < 0) | (encoded_gt >= len(self.table))
+        if not unknown.any():
+            chars = self.table[encoded_gt]
+            unknown = chars == ""
+            if not unknown.any():
+                return "".join(chars.tolist())
+        raise KeyError(int(encoded_gt[np.argmax(unknown)]))
 
 def random_from_list(input_list):
     """
     Select one element from the input_list as random and return it.
     """
-    return input_list[randint(0, len(input_list) - 1)]
+    return choice(input_list)
 
 
 def load_char_map_file(path: str) -> dict:
@@ -113,13 +133,19 @@ def load_char_map_file(path: str) -> dict:
     -------
     A dict maps chars to int.
     """
+    # Return a copy to prevent callers from changing the cached map
+    return dict(_load_char_map(path))
+
+
+@lru_cache(maxsize=None)
+def _load_char_map(path: str) -> dict:
+    """
+    Parse the map file once per path and cache the result. The returned dict is
+    shared between callers and shouldn't be modified.
+    """
     with open(path, "r") as f:
-        file = f.readlines()
-    # Create a dict that maps unique chars to ints
-    char_to_int_map = {}
-    for line in file:
-        char_to_int_map[line[0]] = int(line[2:5])
-    return char_to_int_map
+        # Create a dict that maps unique chars to ints
+        return {line[0]: int(line[2:5]) for line in f}
 
 
 def show_imgs(imgs, gts, details=None, permute=False):
@@ -190,31 +216,13 @@ def clean_sentence(
     input_sent (np.ndarray): Input sentence that is a vector with the length of ``input_sent``.
     ``input_sent`` should be an encoded string.
     """
-    first_eos_indices = np.where(input_sent == eos_index)[0]
-    if len(first_eos_indices) != 0:
+    is_eos = input_sent == eos_index
+    if is_eos.any():
         # Remove <eos> and characters after that
-        input_sent = input_sent[: first_eos_indices.min()]
-    input_sent = input_sent[np.where(input_sent != sos_index)[0]]
-    # Remove the remaining ignore tokens
-    input_sent = input_sent[np.where(input_sent != ignore_token_index)[0]]
-    return input_sent
-
+        input_sent = input_sent[: is_eos.argmax()]
+    # Remove <sos> and ignore tokens with one mask
+    return input_sent[(input_sent != sos_index) & (input_sent != ignore_token_index)]
 
-def load_char_map_file(path: str) -> dict:
-    """
-    Load a map between characters and numbers.
-
-    Returns
-    -------
-    A dict maps chars to int.
-    """
-    with open(path, "r") as f:
-        file = f.readlines()
-    # Create a dict that maps unique chars to ints
-    char_to_int_map = {}
-    for line in file:
-        char_to_int_map[line[0]] = int(line[2:5])
-    return char_to_int_map
 
 def split_data(info_path:str, train_ratio=65, validation_ratio=25):
     """